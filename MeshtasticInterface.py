@@ -8,18 +8,30 @@ import sys
 import threading
 import time
 import socket
-import random
+import selectors
+import math
+import queue
 
 from RNS.Interfaces.Interface import Interface
-# TODO: refactor these to use the utils so it's all in one place
-# TODO: but can't import here because of how RNS does dynamic loading of custom interfaces... hmmm
-#import meshtastic_utils
 
 # Configuration constants
-MT_MAGIC_0 = 0x94
-MT_MAGIC_1 = 0xc3
-MESH_DEST_ADDR=0xFFFFFFFF
-MESH_SPECIAL_NONCE = 69420 # real mature meshtastic
+PARTIAL_MSG_TIMEOUT = 30 # seconds to wait for the next fragment before giving up on a partial packet, LongFast is slow
+
+# RNS exec()s custom interfaces rather than importing them, so the interfaces
+# directory isn't on the path for the meshtastic_utils.py copied in next to us
+_interface_path = getattr(RNS.Reticulum, "interfacepath", "")
+if _interface_path and _interface_path not in sys.path:
+    sys.path.append(_interface_path)
+
+# Pull these in once here rather than on every packet. If meshtastic or a
+# matching meshtastic_utils is missing, __init__ will tell the user what to do
+_import_error = None
+try:
+    from meshtastic.protobuf.mesh_pb2 import Constants as _Constants
+    from meshtastic.protobuf.portnums_pb2 import PRIVATE_APP as _PRIVATE_APP
+    from meshtastic_utils import MeshPacketEncoder, MeshPacketDecoder, request_mesh_config_info_packet, frame_packets, tune_socket, drain_socket
+except ImportError as e:
+    _import_error = e
 
 
 # Let's define our custom interface class. It must
@@ -49,16 +61,25 @@ class MeshtasticInterface(Interface):
         # interface to function correctly.
         import importlib
         if importlib.util.find_spec('meshtastic') != None:
-            import meshtastic
-            from meshtastic.protobuf.portnums_pb2 import PRIVATE_APP
+            from google.protobuf.internal import api_implementation
+            if api_implementation.Type() not in ("cpp", "upb"):
+                RNS.log("Protobuf is using the pure python implementation, packet handling will be slow.", RNS.LOG_WARNING)
+                RNS.log("You can install a faster one with the command: python3 -m pip install \"protobuf>=4.21\"", RNS.LOG_WARNING)
         else:
             RNS.log("Using this interface requires a meshtastic module to be installed.", RNS.LOG_CRITICAL)
             RNS.log("You can install one with the command: python3 -m pip install meshtastic", RNS.LOG_CRITICAL)
             RNS.panic()
 
+        # an older meshtastic_utils.py elsewhere on the path imports fine but
+        # is missing what we need, so go by what the import actually said
+        if _import_error != None:
+            RNS.log("Could not load this interface's packet handling: "+str(_import_error), RNS.LOG_CRITICAL)
+            RNS.log("Copy the meshtastic_utils.py that came with this MeshtasticInterface.py into "+str(_interface_path), RNS.LOG_CRITICAL)
+            RNS.panic()
+
         # We start out by initialising the super-class
         super().__init__()
-        self._recvbuf = bytes()
+        self._decoder = MeshPacketDecoder()
         self._recv_partial_msg = []
 
         # To make sure the configuration data is in the
@@ -100,10 +121,33 @@ class MeshtasticInterface(Interface):
         # be the maximum data packet payload size that the
         # underlying medium is capable of handling in all
         # cases without any segmentation.
-        self.HW_MTU = meshtastic.protobuf.mesh_pb2.Constants.DATA_PAYLOAD_LEN - 32 # Want less than payload to account for padding, 32 pulled out of hat
+        self.HW_MTU = _Constants.DATA_PAYLOAD_LEN - 32 # Want less than payload to account for padding, 32 pulled out of hat
         self.owner = owner
-        self.mesh_port_num = PRIVATE_APP
-        
+        self.mesh_port_num = _PRIVATE_APP
+
+        # Everything but the payload and portnum is the same for every fragment
+        # we send, so the encoder sets that up once.
+        # id always 0 for no-ack
+        self._encoder = MeshPacketEncoder(self.channel, max_len=_Constants.DATA_PAYLOAD_LEN - 4)
+        if api_implementation.Type() == "python" and not self._encoder.hand_encoded:
+            RNS.log("Hand encoded ToRadio doesn't match protobuf for "+str(self)+", falling back to protobuf", RNS.LOG_WARNING)
+
+        # If the final fragment gets lost we'd otherwise keep piling fragments
+        # onto the partial packet forever. No real packet needs more than this
+        max_packet = max(self.HW_MTU, RNS.Reticulum.MTU)
+        self._recv_partial_max = math.ceil(max_packet / self._encoder.max_len) + 2
+        self._recv_partial_deadline = 0
+        # set once a packet blows through that, until its final fragment goes by
+        self._recv_discarding = False
+
+        # Transport calls process_outgoing from more than one thread, this keeps
+        # one packet's fragments from being interleaved with another's on the socket
+        self._tx_lock = threading.Lock()
+
+        # Reassembled packets get handed to Transport from their own
+        # thread, so a slow inbound() doesn't hold up reading the socket
+        self._rx_q = queue.SimpleQueue()
+
         # We initially set the "online" property to false,
         # since the interface has not actually been fully
         # initialised and connected yet.
@@ -123,6 +167,12 @@ class MeshtasticInterface(Interface):
             RNS.log("Could not open TCP port for interface "+str(self), RNS.LOG_ERROR)
             raise e
 
+        # started only once the port is open, so a failed open does not leave
+        # a consumer thread blocked on the queue forever
+        rx_thread = threading.Thread(target=self.rx_loop)
+        rx_thread.daemon = True
+        rx_thread.start()
+
         self.configure_device()
 
     def open_port(self):
@@ -130,27 +180,22 @@ class MeshtasticInterface(Interface):
         # Create and connect socket
         sock = socket.socket()
         sock.connect((self.host, self.port))
+        tune_socket(sock)
         #print("Connected to Meshtastic device", file=sys.stderr)
         
         # without this it won't send us anything
-        sock.send(self._request_mesh_config_info_packet())
+        sock.send(request_mesh_config_info_packet())
+        # give the hardware a moment to get going, once per connect
+        sleep(0.5)
         self._sock = sock
+        self._sel = selectors.DefaultSelector()
+        self._sel.register(sock, selectors.EVENT_READ)
         
-    def _request_mesh_config_info_packet(self):
-        from meshtastic.protobuf.mesh_pb2 import ToRadio
-        to_radio = ToRadio()
-        to_radio.want_config_id = MESH_SPECIAL_NONCE
-        packet = to_radio.SerializeToString()
-            
-        buflen = len(packet)
-        return bytes([MT_MAGIC_0, MT_MAGIC_1, (buflen >> 8) & 0xFF, buflen & 0xFF]) + packet
-    
     # The only thing required after opening the port
-    # is to wait a small amount of time for the
-    # hardware to initialise and then start a thread
-    # that reads any incoming data from the device.
+    # (which already waited for the hardware to
+    # initialise) is to start a thread that reads
+    # any incoming data from the device.
     def configure_device(self):
-        sleep(0.5)
         thread = threading.Thread(target=self.read_loop)
         thread.daemon = True
         thread.start()
@@ -158,123 +203,111 @@ class MeshtasticInterface(Interface):
         RNS.log("Meshtastic TCP port "+self.host+":"+str(self.port)+" is now open", RNS.LOG_VERBOSE)
 
 
-    # This method will be called from our read-loop
-    # whenever a full packet has been received over
-    # the underlying medium.
-    def process_incoming(self, data):
+    # This method will be called from our rx loop
+    # with all the full packets that were received
+    # over the underlying medium in one read.
+    def process_incoming(self, packets):
         # Update our received bytes counter
-        self.rxb += len(data)            
+        self.rxb += sum(len(data) for data in packets)
 
-        # And send the data packet to the Transport
+        # And send the data packets to the Transport
         # instance for processing.
-        self.owner.inbound(data, self)
+        inbound = self.owner.inbound
+        for data in packets:
+            inbound(data, self)
 
-    # Create a Meshtastic packet containing the provided data
-    # Returns a serialized MeshPacket
+    # Create the Meshtastic packets containing the provided data
+    # Returns a list of (framing header, serialized ToRadio) tuples
     def _create_mesh_packets(self, data):
-        from meshtastic.protobuf.mesh_pb2 import ToRadio, Constants
-        
-        result = []
-        MAX_LEN = Constants.DATA_PAYLOAD_LEN - 4
-        for start_byte in range(0, len(data), MAX_LEN):
-            to_radio = ToRadio()
-            mesh_packet = to_radio.packet
-            mesh_packet.decoded.payload = data[start_byte:start_byte+MAX_LEN]
-            #TODO register a specific private mesh port above this value?
-            mesh_packet.decoded.portnum = self.mesh_port_num   #TEXT_MESSAGE_APP
-            # Set other required fields
-            mesh_packet.to = MESH_DEST_ADDR     # Broadcast
-            mesh_packet.id = 0 # id always 0 for no-ack random.randint(0, 0x7FFFFFFF)  # Generate unique ID
-            mesh_packet.channel = self.channel
-            mesh_packet.want_ack = False
-            
-            # increment the portnum of the last packet in the series to indicate we're finished with this reticulum packet
-            # TODO: THis is efficient but probably not what meshtatsic had in mind.  A better way?
-            if start_byte+MAX_LEN >= len(data):
-                mesh_packet.decoded.portnum+=1
-            
-            packet = to_radio.SerializeToString()
-            
-            buflen = len(packet)
-            result.append(bytes([MT_MAGIC_0, MT_MAGIC_1, (buflen >> 8) & 0xFF, buflen & 0xFF]) + packet)
- 
-        return result
-    
-    def _decode_mesh_packets(self,data):
-        from meshtastic.protobuf.mesh_pb2 import FromRadio
-        # add it to our buffer
-        self._recvbuf += data
-        # eat through recvbuf until we get MT_MAGIC_0
-        first_magic_idx = self._recvbuf.find(MT_MAGIC_0)
-        if first_magic_idx < 0:
-            self._recvbuf = b''
-            return []
-            
-        elif first_magic_idx > 0:
-            self._recvbuf = self._recvbuf[first_magic_idx:]
-        
-        result = []
-        # +4 because a data packet is AT LEAST 4 bytes long
-        while len(self._recvbuf) > 4:
-            # if we got the magic bytes
-            if self._recvbuf[0] == MT_MAGIC_0 and self._recvbuf[1] == MT_MAGIC_1:
-                # next two bytes are the size
-                payload_len = self._recvbuf[2] << 8 | self._recvbuf[3] 
-                start_packet_idx = 4
-                end_packet_idx = start_packet_idx + payload_len
-                # if we don't have the full packer, then we're done, wait until later
-                if end_packet_idx > len(self._recvbuf):
-                    return result
-                
-                packet_buf = self._recvbuf[start_packet_idx:end_packet_idx]
-                # Extract the payload from the Meshtastic packet
-                from_radio = FromRadio.FromString(packet_buf)
-                packet = from_radio.packet
-                result.append(packet)
-                # cut the packet off from the current buff
-                self._recvbuf = self._recvbuf[end_packet_idx:]
-            else:
-                self._recvbuf = self._recvbuf[1:] #move it up one    
-                
-        return result
+        #TODO register a specific private mesh port above this value?
+        # increment the portnum of the last packet in the series to indicate we're finished with this reticulum packet
+        # TODO: THis is efficient but probably not what meshtatsic had in mind.  A better way?
+        return self._encoder.create_mesh_packets(data, self.mesh_port_num, end_portnum=self.mesh_port_num + 1)
+
     # The running Reticulum Transport instance will
     # call this method on the interface whenever the
     # interface must transmit a packet.
     def process_outgoing(self,data):
         if self.online:
-            for packet in self._create_mesh_packets(data):
-                self.txb += self._sock.send(packet)
+            # all the fragments go out in one write, sendall takes care of short writes
+            with self._tx_lock:
+                framed = frame_packets(self._create_mesh_packets(data))
+                self._sock.sendall(framed)
+                self.txb += len(framed)
     
                    
+    # Runs in its own thread for the life of the interface,
+    # passing each batch of packets the read loop
+    # reassembled on to process_incoming.
+    def rx_loop(self):
+        while True:
+            self.process_incoming(self._rx_q.get())
+
     # This read loop runs in a thread and continously
     # receives bytes from the underlying serial port.
     # When a full packet has been received, it will
-    # be sent to the process_incoming methed, which
-    # will in turn pass it to the Transport instance.
+    # be queued for rx_loop to send to the
+    # process_incoming methed, which will in turn pass
+    # it to the Transport instance.
     def read_loop(self):
-        while True:
-            sleep(0.05) # give some time, we slow 
-            buf = self._sock.recv(2048)
-            
-            # 0 len means socket broke
+        connected = True
+        while connected:
+            # wait until there's something for us
+            if not self._sel.select(timeout=1.0):
+                continue
+            # take everything that's queued so a burst gets parsed in one go
+            buf, connected = drain_socket(self._sock, self._sel)
             if len(buf) == 0:
-                break
+                continue
             
-            packets = self._decode_mesh_packets(buf)
+            packets = self._decoder.decode(buf)
             RNS.log("Got buf of len="+str(len(buf))+" num packets="+str(len(packets)), RNS.LOG_VERBOSE)
+            # everything we finish reassembling from this read goes up as one batch
+            completed = []
+            channel = self.channel
+            final_portnum = self.mesh_port_num + 1
             for packet in packets:
                 if packet.HasField('decoded'):
                     # ignore other channels that we aren't using as a bridge
-                    if packet.channel == self.channel:
-                        #add it to our list of recv messages
-                        self._recv_partial_msg.append(packet)
-                        # if it's portnum is PRIVATE_APP+1, then we know it's the end, so send them all up for processing
-                        if packet.decoded.portnum == self.mesh_port_num + 1:
-                            r_packet = b''.join(x.decoded.payload for x in self._recv_partial_msg)
-                            self.process_incoming(r_packet)
+                    if packet.channel == channel:
+                        # drop whatever we had if its final fragment never showed up,
+                        # and start over with this one
+                        now = time.monotonic()
+                        if now > self._recv_partial_deadline:
+                            if self._recv_partial_msg:
+                                RNS.log("Dropping "+str(len(self._recv_partial_msg))+" fragments of an incomplete packet on "+str(self), RNS.LOG_DEBUG)
+                                self._recv_partial_msg = []
+                            self._recv_discarding = False
+                        self._recv_partial_deadline = now + PARTIAL_MSG_TIMEOUT
+                        
+                        decoded = packet.decoded
+                        # if it's portnum is PRIVATE_APP+1, then we know it's the end
+                        is_final = decoded.portnum == final_portnum
+                        if self._recv_discarding:
+                            # still in a packet that was too big, skip the rest of it
+                            if is_final:
+                                self._recv_discarding = False
+                            continue
+                        
+                        #add its payload to our list of recv messages
+                        self._recv_partial_msg.append(decoded.payload)
+                        if is_final:
+                            # send them all up for processing
+                            r_packet = b''.join(self._recv_partial_msg)
+                            completed.append(r_packet)
                             self._recv_partial_msg = [] # clear buffer
+                        elif len(self._recv_partial_msg) >= self._recv_partial_max:
+                            # no real packet is this long, throw away everything up to its final fragment
+                            # so the tail of it never goes up to Transport on its own
+                            RNS.log("Dropping "+str(len(self._recv_partial_msg))+" fragments of an oversized packet on "+str(self), RNS.LOG_DEBUG)
+                            self._recv_partial_msg = []
+                            self._recv_discarding = True
+            
+            if completed:
+                self._rx_q.put(completed)
                 
         # something broke, we need to reconnect
+        self._sel.close()
         self.online = False
         self.reconnect_port()
 
@@ -1,10 +1,16 @@
 import sys
 import os
 import socket
+import selectors
 import argparse
 import time
 import random
 import threading
+import struct
+import functools
+import itertools
+from google.protobuf.internal import api_implementation
+from google.protobuf.message import DecodeError
 from meshtastic.protobuf.mesh_pb2 import Data, MeshPacket, Constants, ToRadio, FromRadio
 from meshtastic.protobuf.portnums_pb2 import PRIVATE_APP, TEXT_MESSAGE_APP
 
@@ -15,67 +21,306 @@ MT_MAGIC_0 = 0x94
 MT_MAGIC_1 = 0xc3
 MESH_DEST_ADDR=0xFFFFFFFF
 MESH_SPECIAL_NONCE = 69420 # real mature meshtastic
+SOCK_BUF_SIZE = 262144 # kernel send/recv buffer, so bursts queue up in the kernel and not on the radio
+RECV_SIZE = 16384 # read in big chunks so bursts get parsed in one go
 
 BUFFER_SIZE = 10000 
 MAX_MESH_PACKET = Constants.DATA_PAYLOAD_LEN - 1 
 
+# framing header: 2 magic bytes then the big endian length of the protobuf that follows
+_HDR = struct.Struct(">BBH")
+_MAGIC2 = bytes([MT_MAGIC_0, MT_MAGIC_1])
+# fixed32 fields are little endian
+_FIXED32 = struct.Struct("<I")
+
+# protobuf base 128 varint
+def _varint(n):
+    out = bytearray()
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return out
+
+# protobuf tag for a length delimited (wire type 2), fixed32 (wire type 5) or varint (wire type 0) field
+def _field_tag(descriptor, field_name):
+    field = descriptor.fields_by_name[field_name]
+    if field.type in (field.TYPE_MESSAGE, field.TYPE_BYTES, field.TYPE_STRING):
+        wire_type = 2
+    elif field.type in (field.TYPE_FIXED32, field.TYPE_SFIXED32):
+        wire_type = 5
+    else:
+        wire_type = 0
+    return bytes(_varint(field.number << 3 | wire_type))
+
+def tune_socket(sock):
+    """
+    Set up a freshly connected meshtastic TCP socket for low latency and bursty traffic
+    """
+    # fragments are already length-prefixed, don't let nagle sit on them
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCK_BUF_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCK_BUF_SIZE)
+
+def frame_packet(packet):
+    """
+    Prepend the meshtastic TCP framing header to a serialized protobuf
+    """
+    buflen = len(packet)
+    framed = bytearray(_HDR.size + buflen)
+    _HDR.pack_into(framed, 0, MT_MAGIC_0, MT_MAGIC_1, buflen)
+    framed[_HDR.size:] = packet
+    return framed
+
+def frame_packets(fragments):
+    """
+    Join the (header, packet) tuples from MeshPacketEncoder.create_mesh_packets
+    into one buffer for a single write
+    """
+    return b''.join(itertools.chain.from_iterable(fragments))
+
 def request_mesh_config_info_packet():
     to_radio = ToRadio()
     to_radio.want_config_id = MESH_SPECIAL_NONCE
     packet = to_radio.SerializeToString()
         
-    buflen = len(packet)
-    return bytes([MT_MAGIC_0, MT_MAGIC_1, (buflen >> 8) & 0xFF, buflen & 0xFF]) + packet
-    
+    return bytes(frame_packet(packet))
 
-def create_mesh_packet(data, mesh_channel:int, portnum=PRIVATE_APP):
+
+class MeshPacketEncoder:
     """
-    Create a Meshtastic packet containing the provided data
-    Returns a serialized MeshPacket
+    Splits data into serialized ToRadio packets broadcast on one channel
+    Everything but the payload, portnum and id is the same for every fragment, so on the pure
+    python protobuf backend the bytes are written by hand instead of going through protobuf.
+    The native backends serialize faster than that, so they just fill in the template.
+    The hand rolled encoding is checked against protobuf up front and protobuf gets used
+    instead if they disagree, so a schema change can't silently break us
     """
-   
-    result = b''
     
-    for start_byte in range(0, len(data), MAX_MESH_PACKET):
-        to_radio = ToRadio()
-        mesh_packet = to_radio.packet
-        mesh_packet.decoded.payload = data[start_byte:start_byte+MAX_MESH_PACKET]
-        #TODO register a specific private mesh port above this value?
-        mesh_packet.decoded.portnum = portnum   #PRIVATE_APP or TEXT_MESSAGE_APP most common
+    def __init__(self, mesh_channel:int, max_len:int = MAX_MESH_PACKET):
+        self.max_len = max_len
+        self._to_radio = ToRadio()
+        mesh_packet = self._to_radio.packet
         # Set other required fields
         mesh_packet.to = MESH_DEST_ADDR     # Broadcast
-        mesh_packet.id = random.randint(0, 0x7FFFFFFF)  # Generate unique ID
         mesh_packet.channel = mesh_channel
         mesh_packet.want_ack = False
-
-        packet = to_radio.SerializeToString()
+        # RNS Transport.transmit calls process_outgoing from several threads without a lock,
+        # so only one of them gets to fill in and serialize _to_radio at a time
+        self._lock = threading.Lock()
+        self._wire = self._build_wire() if api_implementation.Type() == "python" else None
+        
+    def _build_wire(self):
+        mesh_packet = self._to_radio.packet
+        decoded_number = MeshPacket.DESCRIPTOR.fields_by_name["decoded"].number
+        id_field = MeshPacket.DESCRIPTOR.fields_by_name["id"]
+        if id_field.type != id_field.TYPE_FIXED32:
+            return None
+        
+        # protobuf writes fields in number order, so the static ones go either side of decoded
+        head = MeshPacket()
+        tail = MeshPacket()
+        head.CopyFrom(mesh_packet)
+        tail.CopyFrom(mesh_packet)
+        for field, _ in mesh_packet.ListFields():
+            if field.number > decoded_number:
+                head.ClearField(field.name)
+            else:
+                tail.ClearField(field.name)
+        wire = (
+            _field_tag(ToRadio.DESCRIPTOR, "packet"),
+            head.SerializeToString(),
+            _field_tag(MeshPacket.DESCRIPTOR, "decoded"),
+            _field_tag(Data.DESCRIPTOR, "portnum"),
+            _field_tag(Data.DESCRIPTOR, "payload"),
+            _field_tag(MeshPacket.DESCRIPTOR, "id"),
+            tail.SerializeToString(),
+        )
+        
+        check = ToRadio()
+        check.CopyFrom(self._to_radio)
+        for payload in (b"\x00", (bytes(range(256)) * (self.max_len // 256 + 1))[:self.max_len]):
+            for portnum in (TEXT_MESSAGE_APP, PRIVATE_APP, PRIVATE_APP + 1):
+                for packet_id in (0, 0x7FFFFFFF):
+                    check.packet.decoded.payload = payload
+                    check.packet.decoded.portnum = portnum
+                    check.packet.id = packet_id
+                    if self._encode(payload, portnum, packet_id, wire) != check.SerializeToString():
+                        return None
+        return wire
+    
+    # Equivalent of setting payload, portnum and id on _to_radio and calling SerializeToString()
+    def _encode(self, payload, portnum, packet_id, wire):
+        packet_tag, head, decoded_tag, portnum_tag, payload_tag, id_tag, tail = wire
+        data_msg = bytearray(portnum_tag)
+        data_msg += _varint(portnum)
+        data_msg += payload_tag
+        data_msg += _varint(len(payload))
+        data_len = _varint(len(data_msg) + len(payload))
+        # 0 is the default so protobuf leaves it out
+        id_len = len(id_tag) + _FIXED32.size if packet_id else 0
+        mesh_packet_len = len(head) + len(decoded_tag) + len(data_len) + len(data_msg) + len(payload) + id_len + len(tail)
         
-        buflen = len(packet)
-        result+= bytes([MT_MAGIC_0, MT_MAGIC_1, (buflen >> 8) & 0xFF, buflen & 0xFF]) + packet
+        out = bytearray(packet_tag)
+        out += _varint(mesh_packet_len)
+        out += head
+        out += decoded_tag
+        out += data_len
+        out += data_msg
+        out += payload
+        if packet_id:
+            out += id_tag
+            out += _FIXED32.pack(packet_id)
+        out += tail
+        return bytes(out)
     
-    return result
+    @property
+    def hand_encoded(self):
+        """
+        False if protobuf is doing the serializing, either because it has a native backend
+        or because the hand rolled encoding didn't match it
+        """
+        return self._wire is not None
+    
+    def encode(self, payload, portnum, packet_id=0):
+        """
+        Returns a serialized ToRadio carrying payload on portnum
+        """
+        if self._wire is not None:
+            return self._encode(payload, portnum, packet_id, self._wire)
+        
+        with self._lock:
+            mesh_packet = self._to_radio.packet
+            mesh_packet.decoded.payload = payload
+            mesh_packet.decoded.portnum = portnum
+            mesh_packet.id = packet_id
+            return self._to_radio.SerializeToString()
+    
+    def create_mesh_packets(self, data, portnum=PRIVATE_APP, end_portnum=None, random_ids=False):
+        """
+        Create the Meshtastic packets containing the provided data, split into max_len fragments
+        The last fragment is sent on end_portnum instead if given, random_ids gives every fragment
+        its own id rather than 0
+        Returns a list of (framing header, serialized ToRadio) tuples, join them with frame_packets
+        """
+        result = []
+        # pull everything the loop needs into locals up front
+        max_len = self.max_len
+        data_len = len(data)
+        encode = self.encode
+        pack_header = _HDR.pack
+        randint = random.randint
+        for start_byte in range(0, data_len, max_len):
+            fragment_portnum = portnum
+            if end_portnum is not None and start_byte+max_len >= data_len:
+                fragment_portnum = end_portnum
+            packet_id = randint(0, 0x7FFFFFFF) if random_ids else 0 # Generate unique ID
+            
+            packet = encode(data[start_byte:start_byte+max_len], fragment_portnum, packet_id)
+            result.append((pack_header(MT_MAGIC_0, MT_MAGIC_1, len(packet)), packet))
+        
+        return result
 
-def decode_mesh_packets(data):
+
+# create_mesh_packet gets called with the same few channels over and over
+@functools.lru_cache(maxsize=None)
+def _channel_encoder(mesh_channel):
+    return MeshPacketEncoder(mesh_channel)
+
+def create_mesh_packet(data, mesh_channel:int, portnum=PRIVATE_APP):
+    """
+    Create a Meshtastic packet containing the provided data
+    Returns the framed, serialized ToRadio packets for every fragment in one buffer
+    """
+    fragments = _channel_encoder(mesh_channel).create_mesh_packets(data, portnum, random_ids=True)
+    return frame_packets(fragments)
+
+def _decode_mesh_packets(buf, pos=0):
+    """
+    Decode the framed FromRadio packets in buf starting at pos
+    Returns the list of MeshPackets and the position of the first unconsumed byte
+    so the caller can keep any partial packet around for the next read
+    """
    
     result = []
-    idx=0
-    while idx < len(data):
+    while len(buf) - pos >= 4:
+        # magic bytes then the size, all in one go
+        magic_0, magic_1, payload_len = _HDR.unpack_from(buf, pos)
         # if we got the magic bytes
-        if data[idx] == MT_MAGIC_0 and data[idx + 1] == MT_MAGIC_1:
-            # next two bytes are the size
-            payload_len = data[idx+2] << 8 | data[idx+3] 
-            start_packet_idx = idx+4
+        if magic_0 == MT_MAGIC_0 and magic_1 == MT_MAGIC_1:
+            start_packet_idx = pos+4
             end_packet_idx = start_packet_idx + payload_len
-            packet_buf = data[start_packet_idx:end_packet_idx]
+            # not all here yet, wait for more data
+            if end_packet_idx > len(buf):
+                break
             # Extract the payload from the Meshtastic packet
-            from_radio = FromRadio.FromString(packet_buf)
-            packet = from_radio.packet
-            result.append(packet)
-            idx = end_packet_idx
-        else:
-            idx+=1    
-            
-    return result
+            try:
+                packet = FromRadio.FromString(buf[start_packet_idx:end_packet_idx]).packet
+            except DecodeError:
+                # the magic bytes were just garbage that happened to match, resync below
+                packet = None
+            if packet is not None:
+                result.append(packet)
+                pos = end_packet_idx
+                continue
+        
+        # skip straight to the next magic bytes
+        next_magic = buf.find(_MAGIC2, pos + 1)
+        if next_magic < 0:
+            # keep the last byte, it might be the first half of the magic
+            pos = len(buf) - 1
+            break
+        pos = next_magic
+
+    return result, pos
+
+def decode_mesh_packets(data):
+    """
+    Decode the framed FromRadio packets in data
+    Returns the list of MeshPackets, a partial packet at the end is left out
+    Use MeshPacketDecoder to keep it around for the next read instead
+    """
+    return _decode_mesh_packets(data)[0]
+
+
+class MeshPacketDecoder:
+    """
+    Decodes the stream of framed FromRadio packets coming off a meshtastic TCP socket,
+    holding on to partial packets between reads
+    """
+    
+    def __init__(self):
+        self._recvbuf = bytearray()
+        self._recv_pos = 0
+        
+    def decode(self, data):
+        """
+        Add data read off the socket, returns the MeshPackets it completed
+        """
+        self._recvbuf.extend(data)
+        packets, pos = _decode_mesh_packets(self._recvbuf, self._recv_pos)
+        # only compact once in a while so we aren't copying the remainder for every packet
+        if pos > 4096 or pos > len(self._recvbuf) // 2:
+            del self._recvbuf[:pos]
+            pos = 0
+        self._recv_pos = pos
+        return packets
+
+
+def drain_socket(sock, sel):
+    """
+    Read everything that's queued on sock, using sel to check for more data
+    so sock can stay blocking for sends
+    Returns the data and False if the socket was closed
+    """
+    data = bytearray()
+    while True:
+        chunk = sock.recv(RECV_SIZE)
+        if not chunk:
+            return data, False
+        data += chunk
+        if not sel.select(timeout=0):
+            return data, True
 
 class MeshtasticHandle:
     
@@ -85,40 +330,45 @@ class MeshtasticHandle:
         self.channel = channel
         sock = socket.socket()
         sock.connect((host, port))
+        tune_socket(sock)
         
         # without this it won;t send us anything
         sock.send(request_mesh_config_info_packet())
+        # give the node a moment to settle after the handshake
+        time.sleep(0.5)
         self.sock = sock
+        self._decoder = MeshPacketDecoder()
         
         self._loop = threading.Thread(target=self._recv_loop, args=(callback, ), daemon=True)
         self._loop.start()
         
     def send_text(self, text):
         mesh_packet = create_mesh_packet(text.encode('utf-8'),mesh_channel=self.channel, portnum=TEXT_MESSAGE_APP)
-        self.sock.send(mesh_packet)
+        self.sock.sendall(mesh_packet)
         
     def send_data(self, text):
         mesh_packet = create_mesh_packet(text.encode('utf-8'),mesh_channel=self.channel, portnum=PRIVATE_APP)
-        self.sock.send(mesh_packet)
+        self.sock.sendall(mesh_packet)
         
     def _recv_loop(self, callback):
         
-        time.sleep(0.5)
-        while True:
-            data = self.sock.recv(1024)
+        sel = selectors.DefaultSelector()
+        sel.register(self.sock, selectors.EVENT_READ)
+        connected = True
+        while connected:
+            # wait until there's something for us, then take everything that's queued
+            if not sel.select(timeout=1.0):
+                continue
+            data, connected = drain_socket(self.sock, sel)
             if not data:
-                return
+                continue
             
-            for packet in decode_mesh_packets(data):
+            for packet in self._decoder.decode(data):
                 if packet.HasField('decoded'):
                     # ignore other channels that we aren't using as a bridge
                     if packet.channel == self.channel:
                         # Write the payload directly to stdout
                         callback(packet.decoded.payload.decode("utf-8",errors="backslashreplace"))
-                        #print("<--got packet", file=sys.stderr)    
-            
-        
-        
-        
+                        #print("<--got packet", file=sys.stderr)
         
-        
\ No newline at end of file
+        sel.close()